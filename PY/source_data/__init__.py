@@ -4,7 +4,12 @@
 Состав:
  :src.py - файл с классами чтения данных из разных источников
  :prepare.py - файл с классом функций предобработки отдельных рядов в классах чтения данных
+ :panel.py - панельные данные "компания - год" (лаги, скользящие средние, срезы по годам) для модели банкротств
+ :backtest.py - бэктест линейных уравнений моделей на расширяющихся и скользящих окнах по всем сценариям
+ :pipeline.py - конвейер расчета моделей комплекса с учетом зависимостей по рядам и мемоизацией этапов
  :utest.py  - тесты
+ :fixtures.py - тестовые бд sqlite3 в формате Питон-моделей для тестов и замеров
+ :bench.py - замеры времени импорта и первого запроса для способов подключения к sqlite3
  :example.py - примеры использования
 
 Задача:
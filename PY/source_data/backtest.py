@@ -0,0 +1,223 @@
+"""Бэктест линейных уравнений моделей АИЖК: переоценка на расширяющемся или скользящем окне
+
+Уравнения моделей (например, досрочное погашение 'CPR ~ _wamvipp + _D1 + _D2 - 1' или
+баланс запуска 'unsold_stock_out ~ unsold_stock.shift(1) + D14 - 1') оцениваются в блокнотах через smf.ols один раз
+на фиксированном периоде. Для проверки устойчивости нужно переоценить уравнение на каждом окне и посчитать ошибку прогноза
+вне выборки - цикл по окнам с patsy и statsmodels получается медленным.
+
+Здесь МНК-оценки для всех окон получаются из накопленных сумм перекрестных произведений X'X и X'y:
+для окна [a, b) X'X = S[b] - S[a], т.е. все окна считаются одним векторным проходом, без повторного построения матриц.
+Расчет ведется сразу по всем сценариям (например, разным вариантам экзогенных рядов) - сценарии образуют
+первую ось массивов.
+
+Состав:
+ :Equation - разбор формулы уравнения (подмножество синтаксиса patsy) и построение матриц по фрейму
+ :rolling_ols - оценки коэффициентов по всем окнам для массивов (сценарии x годы x регрессоры)
+ :BacktestResult - результаты бэктеста: траектории коэффициентов, ошибки вне выборки, RMSE по сценариям
+ :backtest - бэктест уравнения по рабочему фрейму или словарю фреймов сценариев
+
+"""
+
+import numpy as np
+import pandas as pd
+
+import re
+
+
+class Equation:
+    """линейное уравнение модели, заданное формулой
+
+    Поддерживается подмножество синтаксиса patsy, которое используется в моделях:
+     - слагаемые через '+', каждое - имя поля фрейма или сдвиг поля: 'unsold_stock.shift(1)'
+     - '- 1' или '+ 0' - уравнение без константы, иначе добавляется регрессор Intercept
+
+    Атрибуты
+    --------
+    formula : str
+        исходная формула
+    y : tuple
+        зависимая переменная (поле, сдвиг)
+    terms : list
+        регрессоры, список (поле, сдвиг)
+    intercept : bool
+        есть ли константа
+
+    Свойства
+    --------
+    names : list
+        имена коэффициентов (как в smf.ols(...).fit().params)
+
+    """
+    _reTerm = re.compile(r'(\w+)(?:\.shift\((-?\d+)\))?')
+    _strIntercept = 'Intercept'
+
+    def __init__(self, formula:str):
+        """
+
+        :param formula: str
+            формула уравнения, например 'CPR ~ _wamvipp + _D1 + _D2 - 1'
+        """
+        assert type(formula) == str and formula.count('~') == 1, 'wrong formula: {}'.format(formula)
+
+        self.formula = formula
+        lhs, rhs = [s.replace(' ', '') for s in formula.split('~')]
+        self.intercept = True
+        for strNoConst in ('-1', '+0'):
+            if rhs.endswith(strNoConst):
+                self.intercept = False
+                rhs = rhs[:-len(strNoConst)]
+        self.y = Equation._parse_term(lhs)
+        self.terms = [Equation._parse_term(t) for t in rhs.split('+')]
+
+    @staticmethod
+    def _parse_term(strTerm:str)->tuple:
+        m = Equation._reTerm.fullmatch(strTerm)
+        if m is None:
+            raise ValueError('неподдерживаемое слагаемое формулы: {}'.format(strTerm))
+        return m.group(1), int(m.group(2) or 0)
+
+    @staticmethod
+    def _term_name(term:tuple)->str:
+        return term[0] if term[1] == 0 else '{}.shift({})'.format(*term)
+
+    @property
+    def names(self)->list:
+        return ([Equation._strIntercept, ] if self.intercept else []) + [Equation._term_name(t) for t in self.terms]
+
+    @staticmethod
+    def _column(pdf:pd.DataFrame, term:tuple)->np.ndarray:
+        ser = pdf[term[0]]
+        return (ser.shift(term[1]) if term[1] else ser).to_numpy(dtype=float)
+
+    def design(self, pdf:pd.DataFrame):
+        """матрицы уравнения по фрейму (индекс - год точки): y (годы), X (годы x регрессоры)"""
+        lstX = [Equation._column(pdf, t) for t in self.terms]
+        if self.intercept:
+            lstX.insert(0, np.ones(len(pdf)))
+        return Equation._column(pdf, self.y), np.column_stack(lstX)
+
+    def __str__(self)->str:
+        return self.formula
+
+
+def _cumsum0(a:np.ndarray)->np.ndarray:
+    """накопленная сумма по годам (ось 1) с добавленной нулевой точкой в начале"""
+    return np.concatenate([np.zeros(a.shape[:1] + (1,) + a.shape[2:]), np.cumsum(a, axis=1)], axis=1)
+
+
+def rolling_ols(y:np.ndarray, X:np.ndarray, window:int=None, min_obs:int=None):
+    """МНК-оценки на всех окнах, заканчивающихся в каждой точке, по накопленным суммам перекрестных произведений
+
+    Наблюдения с пропусками в y или X не участвуют в оценке (как missing='drop' в smf.ols).
+
+    :param y: numpy array
+        зависимая переменная, (сценарии x годы)
+    :param X: numpy array
+        регрессоры, (сценарии x годы x регрессоры)
+    :param window: int
+        длина скользящего окна; None - расширяющееся окно от начала ряда
+    :param min_obs: int
+        минимальное число наблюдений в окне, по умолчанию - число регрессоров.
+        Для окон с меньшим числом наблюдений коэффициенты - nan
+    :return: tuple
+        beta (сценарии x годы x регрессоры) - оценки на окне, заканчивающемся в году (включительно),
+        nobs (сценарии x годы) - число наблюдений в окне
+    """
+    assert y.ndim == 2 and X.ndim == 3 and y.shape == X.shape[:2], 'wrong shapes for params y, X'
+    iT, iK = X.shape[1:]
+    min_obs = iK if min_obs is None else max(min_obs, iK)
+
+    valid = ~np.isnan(y) & ~np.isnan(X).any(axis=2)
+    Xv = np.where(valid[..., None], X, 0.)
+    yv = np.where(valid, y, 0.)
+
+    # накопленные суммы с нулевой первой точкой: окно [a, b) = S[b] - S[a]
+    S_XX = _cumsum0(np.einsum('stj,stk->stjk', Xv, Xv))
+    S_Xy = _cumsum0(np.einsum('stj,st->stj', Xv, yv))
+    S_n = _cumsum0(valid)
+
+    stop = np.arange(1, iT + 1)
+    start = np.zeros(iT, dtype=int) if window is None else np.maximum(stop - window, 0)
+    wXX = S_XX[:, stop] - S_XX[:, start]
+    wXy = S_Xy[:, stop] - S_Xy[:, start]
+    nobs = S_n[:, stop] - S_n[:, start]
+
+    # pinv вместо solve: в ранних окнах дамми-переменные (D14, _D1, ...) могут быть целиком нулевыми
+    beta = np.einsum('stjk,stk->stj', np.linalg.pinv(wXX), wXy)
+    beta[nobs < min_obs] = np.nan
+    return beta, nobs
+
+
+class BacktestResult:
+    """результаты бэктеста уравнения
+
+    Атрибуты
+    --------
+    params : pandas DataFrame
+        траектории коэффициентов, индекс (scenario, year) - сценарий и последний год окна оценки, колонки - коэффициенты
+    nobs : pandas Series
+        число наблюдений в окне, индекс (scenario, year)
+    forecast : pandas Series
+        прогноз на horizon лет вперед по коэффициентам окна, закончившегося за horizon лет до года индекса
+    errors : pandas Series
+        ошибки прогноза вне выборки (факт - прогноз), индекс (scenario, year) - год прогноза
+
+    Свойства
+    --------
+    rmse : pandas Series
+        среднеквадратичная ошибка вне выборки по сценариям
+
+    """
+    def __init__(self, params:pd.DataFrame, nobs:pd.Series, forecast:pd.Series, errors:pd.Series):
+        self.params = params
+        self.nobs = nobs
+        self.forecast = forecast
+        self.errors = errors
+
+    @property
+    def rmse(self)->pd.Series:
+        return np.sqrt((self.errors ** 2).groupby(level=0, sort=False).mean())
+
+
+def backtest(eq, frames, window:int=None, min_obs:int=None, horizon:int=1)->BacktestResult:
+    """переоценивает уравнение на всех расширяющихся (window=None) или скользящих окнах по всем сценариям
+
+    Для каждого года t коэффициенты оцениваются по наблюдениям окна, заканчивающегося в t, и по ним строится
+    прогноз y на год t+horizon по фактическим регрессорам этого года; ошибка - разность факта и прогноза.
+
+    :param eq: Equation | str
+        уравнение или его формула
+    :param frames: pandas DataFrame | dict
+        рабочий фрейм модели (индекс - год точки) или словарь {сценарий: фрейм}
+    :param window: int
+        длина скользящего окна, None - расширяющееся окно
+    :param min_obs: int
+        минимальное число наблюдений для оценки
+    :param horizon: int
+        горизонт прогноза вне выборки, лет
+    :return: BacktestResult
+    """
+    eq = eq if isinstance(eq, Equation) else Equation(eq)
+    assert horizon > 0, 'wrong value for param horizon'
+    dctFrames = frames if type(frames) == dict else {0: frames}
+
+    idxYears = dctFrames[next(iter(dctFrames))].index
+    for pdf in dctFrames.values():
+        idxYears = idxYears.union(pdf.index)
+    lstScen = list(dctFrames)
+
+    lstDesign = [eq.design(dctFrames[s].reindex(idxYears)) for s in lstScen]
+    y = np.stack([d[0] for d in lstDesign])
+    X = np.stack([d[1] for d in lstDesign])
+
+    beta, nobs = rolling_ols(y, X, window=window, min_obs=min_obs)
+
+    fore = np.full_like(y, np.nan)
+    fore[:, horizon:] = np.einsum('stk,stk->st', X[:, horizon:], beta[:, :-horizon])
+
+    mi = pd.MultiIndex.from_product([lstScen, idxYears], names=['scenario', idxYears.name or 'year'])
+    params = pd.DataFrame(beta.reshape(-1, beta.shape[2]), index=mi, columns=eq.names)
+    nobs = pd.Series(nobs.ravel(), index=mi, name='nobs')
+    forecast = pd.Series(fore.ravel(), index=mi, name=Equation._term_name(eq.y))
+    errors = (pd.Series(y.ravel(), index=mi, name='error') - forecast.rename('error')).dropna()
+    return BacktestResult(params, nobs, forecast, errors)
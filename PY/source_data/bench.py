@@ -0,0 +1,66 @@
+"""
+сравнение способов подключения db_source к файлам sqlite3 (SQLAlchemy и стандартный модуль sqlite3)
+
+Замеряется в отдельных процессах (как у коротко живущего воркера или нового ядра Юпитер):
+ - время импорта source_data.src и, для сравнения, время импорта вместе с SQLAlchemy
+   (так source_data.src импортировался до ленивого импорта SQLAlchemy)
+ - время первого запроса: создание db_source, make_frame и check
+Для замеров создается временная бд в формате Питон-моделей (таблицы datas и headers, см. fixtures.make_db).
+
+запуск из каталога PY: python -m source_data.bench
+"""
+from os import path
+import subprocess
+import sys
+import tempfile
+import statistics
+
+from source_data.fixtures import make_db
+
+_iRuns = 7
+_iRows = 300
+_strPYPath = path.dirname(path.dirname(path.abspath(__file__)))
+
+_strImportCode = '''
+import time
+t = time.perf_counter()
+import {modules}
+print(time.perf_counter() - t)
+'''
+
+_strQueryCode = '''
+import time
+t = time.perf_counter()
+from source_data.src import db_source, RowTypes, DBBackends
+x = db_source({path!r}, RowTypes.FACT, {fields!r}, backend=DBBackends.{backend})
+x.make_frame()
+x.check()
+print(time.perf_counter() - t)
+'''
+
+
+def _measure(strCode:str)->float:
+    """медиана времени выполнения кода в отдельном процессе, сек"""
+    res = [float(subprocess.run([sys.executable, '-c', strCode], capture_output=True, text=True, check=True,
+                                cwd=_strPYPath).stdout) for _ in range(_iRuns)]
+    return statistics.median(res)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as strDir:
+        strDBPath = path.join(strDir, 'year.sqlite3')
+        make_db(strDBPath, ['row_{}'.format(i) for i in range(_iRows)])
+        lstFields = ['row_{}'.format(i) for i in range(0, _iRows, 10)]
+
+        tBase = _measure(_strImportCode.format(modules='sqlalchemy, source_data.src'))
+        t = _measure(_strImportCode.format(modules='source_data.src'))
+        print('import sqlalchemy, source_data.src: {:.1f} ms'.format(tBase * 1e3))
+        print('import source_data.src: {:.1f} ms (-{:.1f} ms)'.format(t * 1e3, (tBase - t) * 1e3))
+        for backend in ('SQLALCHEMY', 'SQLITE3'):
+            t = _measure(_strQueryCode.format(path=strDBPath, fields=lstFields, backend=backend))
+            print('first query, {:<10}: {:.1f} ms'.format(backend, t * 1e3))
+
+
+if __name__ == '__main__':
+    main()
+    print('All done')
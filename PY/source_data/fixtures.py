@@ -0,0 +1,18 @@
+"""
+тестовые бд sqlite3 в формате Питон-моделей (таблицы headers и datas)
+
+Используются модульными тестами (utest.py) и замерами (bench.py); состав рядов и годов каждый из них задает сам.
+"""
+import sqlite3
+
+
+def make_db(strPath:str, lstCodes:list, years=range(1990, 2020)):
+    """создает бд sqlite3 с рядами lstCodes (коды code2) по годам years, значение ряда номер i в году y - (i + y)"""
+    con = sqlite3.connect(strPath)
+    con.execute('create table headers (code integer primary key, mgroup_id integer, name text, unit text, '
+                'code2 text, source text, params json)')
+    con.execute('create table datas (code integer, date integer, value real)')
+    con.executemany('insert into headers (code, code2) values (?, ?)', list(enumerate(lstCodes)))
+    con.executemany('insert into datas values (?, ?, ?)', [(i, y, i + y) for i in range(len(lstCodes)) for y in years])
+    con.commit()
+    con.close()
@@ -0,0 +1,236 @@
+"""Панельные данные "компания - год" для модели банкротств застройщиков
+
+Данные модели банкротств хранятся во фреймах с мультииндексом (inn, year). Операции по компаниям
+(лаги, скользящие средние, заполнение пропусков) через groupby(level=0) работают медленно и требуют ручной правки индекса,
+а срезы по году idx[:, year] в циклах каждый раз просматривают весь индекс.
+
+Класс Panel один раз сортирует строки по компаниям и годам (строки каждой компании идут подряд) и хранит массивы смещений:
+ - _offsets - начало строк каждой компании
+ - _year_offsets - начало строк каждого года в перестановке по годам
+Все операции по компаниям выполняются за один векторный проход по массиву numpy, срез по году - без просмотра индекса.
+Панель хранит только индекс и массивы перестановок, поля читаются из фрейма, переданного в операцию: одну панель можно
+использовать для любых полей фрейма, в том числе добавленных после ее создания, пока не меняется индекс фрейма.
+Результаты операций возвращаются в порядке строк фрейма, с его индексом, и могут сразу записываться во фрейм.
+
+Состав:
+ :Panel - класс панельных данных
+ :expand_from - разворачивает год первого события по компаниям в индекс (компания, год) до последнего года
+
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class Panel:
+    """панель "компания - год" на фрейме с двухуровневым мультииндексом
+
+    ...
+
+    Атрибуты
+    --------
+    _index : pandas MultiIndex
+        индекс фрейма (компания, год), для которого построена панель
+    _order : numpy array
+        перестановка строк исходного фрейма, упорядочивающая их по компаниям и годам
+    _inv : numpy array
+        обратная перестановка (из упорядоченных строк в порядок исходного фрейма)
+    _ent : numpy array
+        номер компании для каждой упорядоченной строки
+    _time : numpy array
+        год для каждой упорядоченной строки
+    _offsets : numpy array
+        смещения: строки компании i - это упорядоченные строки _offsets[i]:_offsets[i+1]
+    _pos : numpy array
+        номер строки внутри своей компании (0 - первый год компании)
+    _year_order : numpy array
+        номера строк фрейма, упорядоченные по годам, а внутри года - по компаниям
+    _year_offsets : numpy array
+        смещения годов в _year_order
+    _dctYears : dict
+        год -> номер года в _year_offsets
+
+    Свойства
+    --------
+    entities : pandas Index
+        компании панели (отсортированы)
+    years : pandas Index
+        годы панели (отсортированы)
+
+    Функции (первый параметр - фрейм с индексом панели)
+    -------
+    shift, lag, lead : pandas DataFrame
+        сдвиг полей внутри компаний
+    rolling_mean, rolling_sum : pandas DataFrame
+        скользящие среднее и сумма внутри компаний
+    ffill : pandas DataFrame
+        заполнение пропусков последним известным значением внутри компаний
+    first_event : pandas Series
+        год первого события (ненулевого значения поля) по компаниям
+    cross_section : pandas DataFrame
+        срез по году
+    year_rows : numpy array
+        номера строк года во фрейме
+
+    """
+    def __init__(self, index):
+        """
+
+        :param index: pandas MultiIndex | pandas DataFrame
+            мультииндекс (компания, год), например (inn, year), или фрейм с таким индексом
+        """
+        index = index.index if isinstance(index, pd.DataFrame) else index
+        assert isinstance(index, pd.MultiIndex) and index.nlevels == 2, \
+            'wrong index for param index - must be MultiIndex (entity, year)'
+
+        # индекс pandas неизменяемый, поэтому хранится ссылка на него, а не копия
+        self._index = index
+        ent_codes, self._entities = pd.factorize(index.get_level_values(0), sort=True)
+        time = np.asarray(index.get_level_values(1))
+
+        self._order = np.lexsort((time, ent_codes))
+        self._inv = np.empty_like(self._order)
+        self._inv[self._order] = np.arange(len(self._order))
+
+        self._ent = ent_codes[self._order]
+        self._time = time[self._order]
+        self._offsets = np.concatenate([[0], np.cumsum(np.bincount(self._ent, minlength=len(self._entities)))])
+        self._pos = np.arange(len(self._ent)) - self._offsets[self._ent]
+
+        year_codes, self._years = pd.factorize(self._time, sort=True)
+        self._year_order = self._order[np.argsort(year_codes, kind='stable')]
+        self._year_offsets = np.concatenate([[0], np.cumsum(np.bincount(year_codes, minlength=len(self._years)))])
+        self._dctYears = {y: i for i, y in enumerate(self._years)}
+
+    @property
+    def entities(self)->pd.Index:
+        return pd.Index(self._entities, name=self._index.names[0])
+
+    @property
+    def years(self)->pd.Index:
+        return pd.Index(self._years, name=self._index.names[1])
+
+    def _check(self, pdf:pd.DataFrame):
+        # перестановки панели рассчитаны для ее индекса: фрейм с другим индексом (новые строки, другой порядок) - ошибка
+        if pdf.index is not self._index and not pdf.index.equals(self._index):
+            raise ValueError('индекс фрейма не совпадает с индексом панели, панель нужно построить заново')
+
+    def _values(self, pdf:pd.DataFrame, columns:list)->np.ndarray:
+        """значения полей фрейма в упорядоченных строках, float"""
+        self._check(pdf)
+        return pdf[columns].to_numpy(dtype=float)[self._order]
+
+    def _frame(self, values:np.ndarray, columns:list)->pd.DataFrame:
+        """фрейм из значений в упорядоченных строках - в порядке строк и с индексом фрейма"""
+        return pd.DataFrame(values[self._inv], index=self._index, columns=columns)
+
+    @staticmethod
+    def _columns(columns)->list:
+        return [columns, ] if type(columns) == str else list(columns)
+
+    def shift(self, pdf:pd.DataFrame, columns, periods:int=1)->pd.DataFrame:
+        """сдвиг полей внутри компаний на periods строк, аналог pdf.groupby(level=0)[columns].shift(periods)
+
+        periods > 0 - лаг (значение предыдущего года), periods < 0 - опережение.
+        В отличие от groupby, строки сдвигаются в порядке годов, а не в порядке строк фрейма"""
+        columns = Panel._columns(columns)
+        vals = self._values(pdf, columns)
+        res = np.full_like(vals, np.nan)
+        if periods > 0:
+            res[periods:] = vals[:-periods]
+            res[self._pos < periods] = np.nan
+        elif periods < 0:
+            res[:periods] = vals[-periods:]
+            size = np.diff(self._offsets)[self._ent]
+            res[self._pos >= size + periods] = np.nan
+        else:
+            res = vals
+        return self._frame(res, columns)
+
+    def lag(self, pdf:pd.DataFrame, columns, periods:int=1)->pd.DataFrame:
+        return self.shift(pdf, columns, periods)
+
+    def lead(self, pdf:pd.DataFrame, columns, periods:int=1)->pd.DataFrame:
+        return self.shift(pdf, columns, -periods)
+
+    def _rolling(self, pdf:pd.DataFrame, columns, window:int, min_periods:int=None):
+        """скользящие сумма и число значений внутри компаний
+
+        Значения окна собираются в массив (строки x window x поля) по индексам строк, окна не выходят за строки
+        своей компании. Сумма считается только по значениям окна (без накопленной суммы по всей панели),
+        поэтому выброс или inf одной компании не влияет на окна других. Как и в pandas, nan и +-inf
+        не учитываются ни в сумме, ни в числе наблюдений"""
+        assert window > 0, 'wrong value for param window'
+        min_periods = window if min_periods is None else min_periods
+        columns = Panel._columns(columns)
+        vals = self._values(pdf, columns)
+
+        rows = np.arange(len(vals))[:, None] - np.arange(window)[None, :]
+        in_firm = rows >= self._offsets[self._ent][:, None]
+        win = vals[np.maximum(rows, 0)]
+        valid = np.isfinite(win) & in_firm[..., None]
+
+        res_sum = np.where(valid, win, 0.).sum(axis=1)
+        res_cnt = valid.sum(axis=1)
+        res_sum[res_cnt < min_periods] = np.nan
+        return columns, res_sum, res_cnt
+
+    def rolling_sum(self, pdf:pd.DataFrame, columns, window:int, min_periods:int=None)->pd.DataFrame:
+        """скользящая сумма внутри компаний, аналог pdf.groupby(level=0)[columns].rolling(window).sum()"""
+        columns, res_sum, _ = self._rolling(pdf, columns, window, min_periods)
+        return self._frame(res_sum, columns)
+
+    def rolling_mean(self, pdf:pd.DataFrame, columns, window:int, min_periods:int=None)->pd.DataFrame:
+        """скользящее среднее внутри компаний, аналог pdf.groupby(level=0)[columns].rolling(window).mean()"""
+        columns, res_sum, res_cnt = self._rolling(pdf, columns, window, min_periods)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._frame(res_sum / res_cnt, columns)
+
+    def ffill(self, pdf:pd.DataFrame, columns)->pd.DataFrame:
+        """заполнение пропусков последним известным значением той же компании, аналог pdf.groupby(level=0)[columns].ffill()"""
+        columns = Panel._columns(columns)
+        vals = self._values(pdf, columns)
+        last = np.where(~np.isnan(vals), np.arange(len(vals))[:, None], -1)
+        last = np.maximum.accumulate(last, axis=0)
+        res = np.take_along_axis(vals, np.maximum(last, 0), axis=0)
+        res[last < self._offsets[self._ent][:, None]] = np.nan
+        return self._frame(res, columns)
+
+    def first_event(self, pdf:pd.DataFrame, column:str)->pd.Series:
+        """год первого ненулевого (непустого) значения поля по компаниям; компании без события в результат не входят"""
+        vals = self._values(pdf, [column, ])[:, 0]
+        rows = np.flatnonzero(~np.isnan(vals) & (vals != 0))
+        ents, first = np.unique(self._ent[rows], return_index=True)
+        return pd.Series(self._time[rows[first]], index=self.entities[ents], name=self._index.names[1])
+
+    def year_rows(self, year)->np.ndarray:
+        """номера строк года во фрейме (упорядочены по компаниям) - для чтения и записи через pdf.iloc"""
+        i = self._dctYears[year]
+        return self._year_order[self._year_offsets[i]:self._year_offsets[i + 1]]
+
+    def cross_section(self, pdf:pd.DataFrame, year)->pd.DataFrame:
+        """срез фрейма по году, аналог pdf.loc[idx[:, year], :]; строки - в порядке year_rows(year)"""
+        self._check(pdf)
+        return pdf.iloc[self.year_rows(year)]
+
+    def __str__(self)->str:
+        return 'Panel: {} entities, years {}-{}, {} rows'.format(len(self._entities), self._years.min(),
+                                                                  self._years.max(), len(self._index))
+
+
+def expand_from(first:pd.Series, last_year:int, names=('inn', 'year'))->pd.MultiIndex:
+    """разворачивает год события по компаниям в индекс (компания, год) для всех годов от года события до last_year
+
+    :param first: pandas Series
+        индекс - компании, значения - год первого события (см. Panel.first_event)
+    :param last_year: int
+        последний год (включительно)
+    :param names: tuple
+        имена уровней итогового мультииндекса
+    :return: pandas MultiIndex
+    """
+    start = first.to_numpy(dtype=int)
+    counts = np.clip(last_year - start + 1, 0, None)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    years = np.repeat(start, counts) + np.arange(counts.sum()) - offsets
+    return pd.MultiIndex.from_arrays([np.repeat(first.index.to_numpy(), counts), years], names=names)
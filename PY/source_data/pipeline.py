@@ -0,0 +1,658 @@
+"""Конвейер расчета моделей АИЖК с учетом зависимостей и мемоизацией этапов
+
+Модели комплекса (цены и себестоимость, баланс запуска, спрос на собственные средства, спрос на ипотеку,
+досрочное погашение, банкротства, выбытие жилья) связаны между собой: результаты одних моделей являются
+входными рядами других. Сейчас эта связь держится на порядке ручного запуска страниц Юпитер, %store и svod.sqlite3.
+
+Модуль позволяет описать каждую модель как этап (Stage) с объявленными входными и выходными рядами (коды code2),
+после чего конвейер (Pipeline) сам определяет порядок расчета, запускает независимые этапы параллельно и
+запоминает результат каждого этапа под хешем его входных рядов, параметров и кода функции.
+При повторном запуске пересчитываются только те этапы, входы которых действительно изменились
+(т.е. этапы ниже по цепочке от измененного экзогенного ряда).
+
+Состав:
+ :Stage - описание этапа конвейера
+ :StageCache - хранилище результатов этапов (в памяти и, при необходимости, в каталоге на диске)
+ :Pipeline - конвейер, граф зависимостей и запуск расчета
+ :dctModelStages - объявления входных и выходных рядов моделей комплекса
+ :model_stage - этап для модели комплекса по ее объявлению
+ :bankruptcy_year_series, bankruptcy_share - годовые ряды и этап модели банкротств застройщиков
+ :disps_houses_year_series, disps_houses - годовые ряды и этап модели выбытия жилья
+
+"""
+
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from enum import Enum
+from hashlib import sha256
+from os import path, makedirs
+from types import CodeType, FunctionType, MethodType, ModuleType
+import dis
+import pickle
+import warnings
+
+
+class Stage:
+    """этап конвейера - одна модель комплекса
+
+    ...
+
+    Атрибуты
+    --------
+    name : str
+        имя этапа, уникальное в пределах конвейера
+    func : callable
+        функция расчета, вызывается как func(pdf, **params), где pdf - фрейм входных рядов (индекс - год точки,
+        колонки - коды code2 из inputs). Должна вернуть фрейм, содержащий все колонки из outputs
+    inputs : list
+        список кодов входных рядов
+    outputs : list
+        список кодов рядов, рассчитываемых этапом
+    params : dict
+        параметры функции расчета (константы модели, границы периодов и т.п.), участвуют в ключе мемоизации
+
+    memoize : bool
+        запоминать ли результат этапа в хранилище
+    class_attrs : list
+        атрибуты глобальных классов, которые читает функция расчета (например ['repay_e.pdfWork'])
+
+    Ключ мемоизации (см. key) складывается из входных рядов, params, кода функции расчета (вместе с вложенными
+    функциями), ее замыкания и значений глобальных переменных, которые она читает напрямую (например, iLastFactYear
+    в странице Юпитер); глобальные функции-помощники учитываются рекурсивно. Атрибуты глобальных классов
+    (prices_cost.cElastiCo, repay_e.pdfWork, common.strSvodDBPath) в ключ не входят, поэтому этап, функция которого
+    их читает, не запоминается: он пересчитывается при каждом запуске, при создании выдается предупреждение.
+    Такие значения нужно передавать через pdf и params. Содержимое файлов и баз данных, которые функция читает сама,
+    в ключ также не входит.
+
+    """
+    def __init__(self, name:str, func, inputs:list, outputs:list, params:dict=None, memoize:bool=True):
+        """
+
+        :param name: str
+            имя этапа
+        :param func: callable
+            функция расчета этапа
+        :param inputs: list | str
+            коды входных рядов. Может быть строкой - один ряд
+        :param outputs: list | str
+            коды выходных рядов. Может быть строкой - один ряд
+        :param params: dict
+            параметры функции расчета
+        :param memoize: bool
+            запоминать ли результат этапа. Если функция читает атрибуты глобальных классов, этап не запоминается
+        """
+        assert callable(func), 'wrong type for param func - must be callable'
+        assert type(inputs) in (str, list, tuple), 'wrong type for param inputs - must be code2 or list of code2'
+        assert type(outputs) in (str, list, tuple), 'wrong type for param outputs - must be code2 or list of code2'
+
+        self.name = name
+        self.func = func
+        self.inputs = [inputs, ] if type(inputs) == str else list(inputs)
+        self.outputs = [outputs, ] if type(outputs) == str else list(outputs)
+        self.params = dict(params) if params else {}
+        self.class_attrs = _class_attrs(func)
+        self.memoize = memoize and not self.class_attrs
+        if memoize and self.class_attrs:
+            warnings.warn('этап {} не будет запоминаться: функция расчета читает атрибуты глобальных классов {}, '
+                          'которые не входят в ключ. Передайте их через pdf и params'.format(name, self.class_attrs))
+
+    def key(self, pdf:pd.DataFrame)->str:
+        """ключ мемоизации этапа: хеш входных рядов, параметров, кода функции расчета и читаемых ею глобальных переменных"""
+        h = sha256()
+        h.update(self.name.encode())
+        _seen = set()
+        _hash_func(h, self.func, _seen)
+        _hash_value(h, self.params, _seen)
+        _pdf = pdf[self.inputs]
+        h.update(repr(_pdf.columns.tolist()).encode())
+        h.update(pd.util.hash_pandas_object(_pdf, index=True).values.tobytes())
+        return h.hexdigest()
+
+    def __call__(self, pdf:pd.DataFrame)->pd.DataFrame:
+        """расчет этапа по фрейму входных рядов, возвращает фрейм выходных рядов"""
+        _res = self.func(pdf[self.inputs].copy(), **self.params)
+        if isinstance(_res, pd.Series):
+            _res = _res.to_frame()
+        missed = set(self.outputs) - set(_res.columns)
+        if missed:
+            raise KeyError('этап {} не вернул объявленные выходные ряды: {}'.format(self.name, sorted(missed)))
+        return _res[self.outputs]
+
+    def __str__(self)->str:
+        return '''{_name}:
+    inputs {_in},
+    outputs {_out}'''.format(_name=self.name, _in=self.inputs, _out=self.outputs)
+
+
+def _hash_value(h, value, _seen:set):
+    """добавляет в хеш h значение параметра, константы или глобальной переменной функции расчета
+
+    Фреймы и серии pandas хешируются по значениям и индексу (pd.util.hash_pandas_object), массивы numpy - по байтам,
+    функции - по коду (см. _hash_func), модули - по имени, остальное - через pickle (repr, если pickle невозможен).
+    Множества упорядочиваются, т.к. порядок их элементов меняется от процесса к процессу."""
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        h.update(repr(type(value)).encode())
+        if isinstance(value, pd.DataFrame):
+            h.update(repr(value.columns.tolist()).encode())
+        h.update(pd.util.hash_pandas_object(value, index=not isinstance(value, pd.Index)).values.tobytes())
+    elif isinstance(value, np.ndarray):
+        h.update(repr((value.dtype.str, value.shape)).encode())
+        h.update(np.ascontiguousarray(value).tobytes() if value.dtype != object else pickle.dumps(value.tolist()))
+    elif isinstance(value, CodeType):
+        _hash_code(h, value, None, _seen)
+    elif isinstance(value, (FunctionType, MethodType)):
+        _hash_func(h, value, _seen)
+    elif isinstance(value, ModuleType):
+        h.update(value.__name__.encode())
+    elif isinstance(value, (set, frozenset)):
+        h.update(repr(type(value)).encode())
+        for b in sorted(_value_bytes(v, _seen) for v in value):
+            h.update(b)
+    elif isinstance(value, (tuple, list)):
+        h.update('{}{}'.format(type(value).__name__, len(value)).encode())
+        for v in value:
+            _hash_value(h, v, _seen)
+    elif isinstance(value, dict):
+        h.update('dict{}'.format(len(value)).encode())
+        for b in sorted(_value_bytes(k, _seen) + _value_bytes(v, _seen) for k, v in value.items()):
+            h.update(b)
+    else:
+        try:
+            h.update(pickle.dumps(value))
+        except Exception:
+            h.update(repr(value).encode())
+
+
+def _value_bytes(value, _seen:set)->bytes:
+    """отдельный хеш элемента множества или словаря (для упорядочивания). Копия _seen - чтобы результат
+    не зависел от порядка обхода элементов"""
+    h = sha256()
+    _hash_value(h, value, set(_seen))
+    return h.digest()
+
+
+def _hash_code(h, code:CodeType, dctGlobals, _seen:set):
+    """байт-код, имена и константы функции; вложенные функции (lambda, генераторы, comprehension) - рекурсивно.
+
+    Объекты кода хешируются по содержимому, а не через repr - repr содержит адрес в памяти и меняется
+    от процесса к процессу. Если заданы dctGlobals, в хеш входят значения глобальных переменных, которые читает код."""
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for c in code.co_consts:
+        _hash_value(h, c, _seen)
+    if dctGlobals is not None:
+        for name in _code_names(code):
+            if name in dctGlobals:
+                h.update(name.encode())
+                _hash_value(h, dctGlobals[name], _seen)
+
+
+def _code_names(code:CodeType)->list:
+    """имена глобальных переменных и атрибутов, используемые кодом и вложенными в него функциями"""
+    lstNames = list(code.co_names)
+    for c in code.co_consts:
+        if isinstance(c, CodeType):
+            lstNames.extend(n for n in _code_names(c) if n not in lstNames)
+    return lstNames
+
+
+def _hash_func(h, func, _seen:set):
+    """хеш функции расчета: код, значения по умолчанию, замыкание и читаемые глобальные переменные
+
+    Глобальные функции-помощники хешируются рекурсивно так же, повторные и циклические ссылки пропускаются."""
+    func = getattr(func, '__func__', func)
+    code = getattr(func, '__code__', None)
+    if code is None:
+        h.update('{}.{}'.format(getattr(func, '__module__', ''), getattr(func, '__qualname__', repr(func))).encode())
+        return
+    if id(func) in _seen:
+        h.update(code.co_name.encode())
+        return
+    _seen.add(id(func))
+    _hash_code(h, code, func.__globals__, _seen)
+    _hash_value(h, func.__defaults__, _seen)
+    _hash_value(h, func.__kwdefaults__, _seen)
+    for cell in func.__closure__ or ():
+        try:
+            _hash_value(h, cell.cell_contents, _seen)
+        except ValueError:  # пустая ячейка замыкания
+            pass
+
+
+def _codes(code:CodeType)->list:
+    """объект кода и все вложенные в него объекты кода (lambda, генераторы, comprehension)"""
+    lstRes = [code, ]
+    for c in code.co_consts:
+        if isinstance(c, CodeType):
+            lstRes.extend(_codes(c))
+    return lstRes
+
+
+def _class_attrs(func, _seen:set=None)->list:
+    """атрибуты глобальных классов, которые читает функция и ее глобальные функции-помощники
+
+    Ищутся пары инструкций "загрузка глобальной переменной (или переменной замыкания) - чтение атрибута",
+    в которых переменная - класс: prices_cost.cElastiCo, repay_e.pdfWork. Перечисления (RowTypes.FACT) не учитываются."""
+    _seen = set() if _seen is None else _seen
+    func = getattr(func, '__func__', func)
+    code = getattr(func, '__code__', None)
+    if code is None or id(func) in _seen:
+        return []
+    _seen.add(id(func))
+
+    dctVars = dict(func.__globals__)
+    for name, cell in zip(code.co_freevars, func.__closure__ or ()):
+        try:
+            dctVars[name] = cell.cell_contents
+        except ValueError:  # пустая ячейка замыкания
+            pass
+
+    lstRes = []
+    for c in _codes(code):
+        prev = None
+        for ins in dis.get_instructions(c):
+            if ins.opname in ('LOAD_ATTR', 'LOAD_METHOD') and prev is not None:
+                v = dctVars.get(prev)
+                name = '{}.{}'.format(prev, ins.argval)
+                if isinstance(v, type) and not issubclass(v, Enum) and name not in lstRes:
+                    lstRes.append(name)
+            prev = ins.argval if ins.opname in ('LOAD_GLOBAL', 'LOAD_DEREF') else None
+            if prev is not None and isinstance(dctVars.get(prev), FunctionType):
+                lstRes.extend(n for n in _class_attrs(dctVars[prev], _seen) if n not in lstRes)
+    return lstRes
+
+
+class StageCache:
+    """хранилище рассчитанных результатов этапов
+
+    Результаты хранятся в памяти процесса по ключу этапа (см. Stage.key). Если задан каталог, результаты
+    дополнительно сохраняются в нем в файлы pickle и переживают перезапуск ядра Юпитер.
+
+    Атрибуты
+    --------
+    _dct : dict
+        результаты в памяти, ключ - хеш этапа, значение - фрейм выходных рядов
+    _strDir : str
+        каталог для хранения результатов на диске, None - только память
+
+    """
+    def __init__(self, strDir:str=None):
+        """
+
+        :param strDir: str
+            каталог для сохранения результатов этапов. None - результаты хранятся только в памяти
+        """
+        self._dct = {}
+        self._strDir = strDir
+        if strDir is not None:
+            makedirs(strDir, exist_ok=True)
+
+    def _file(self, key:str)->str:
+        return path.join(self._strDir, '{}.pkl'.format(key))
+
+    def get(self, key:str):
+        """возвращает сохраненный фрейм или None, если результата с таким ключом нет"""
+        if key in self._dct:
+            return self._dct[key]
+        if self._strDir is not None and path.isfile(self._file(key)):
+            with open(self._file(key), 'rb') as f:
+                self._dct[key] = pickle.load(f)
+            return self._dct[key]
+        return None
+
+    def put(self, key:str, pdf:pd.DataFrame):
+        self._dct[key] = pdf
+        if self._strDir is not None:
+            with open(self._file(key), 'wb') as f:
+                pickle.dump(pdf, f)
+
+    def clear(self):
+        """очищает результаты в памяти (файлы на диске не удаляются)"""
+        self._dct.clear()
+
+    def __len__(self):
+        return len(self._dct)
+
+
+class Pipeline:
+    """конвейер расчета моделей
+
+    Этап B зависит от этапа A, если среди входов B есть ряд из выходов A. Ряды, которые не выдает ни один этап,
+    берутся из исходного фрейма (фактические, экзогенные ряды и параметры, см. common.CombineFrames).
+    Один ряд может рассчитываться только одним этапом, циклы в графе зависимостей не допускаются.
+
+    Атрибуты
+    --------
+    _dctStages : dict
+        этапы конвейера по именам, в порядке добавления
+    cache : StageCache
+        хранилище результатов этапов
+    max_workers : int
+        число потоков для параллельного расчета независимых этапов
+    last_run : dict
+        итог последнего запуска по этапам: 'computed' - этап пересчитан, 'cached' - результат взят из хранилища,
+        'uncached' - этап пересчитан и не запоминается (см. Stage.memoize)
+
+    Свойства
+    --------
+    stages : list
+        список этапов
+    producers : dict
+        соответствие "код ряда -> имя этапа, который его рассчитывает"
+    dependencies : dict
+        соответствие "имя этапа -> множество имен этапов, от которых он зависит"
+
+    Функции
+    -------
+    add : Pipeline
+        добавление этапа
+    order : list
+        имена этапов в порядке расчета
+    downstream : list
+        этапы, зависящие (прямо или через другие этапы) от заданных рядов
+    run : pandas DataFrame
+        расчет конвейера по исходному фрейму
+
+    """
+    def __init__(self, stages:list=None, cache:StageCache=None, max_workers:int=None):
+        """
+
+        :param stages: list
+            список этапов Stage
+        :param cache: StageCache
+            хранилище результатов. По умолчанию - новое хранилище в памяти
+        :param max_workers: int
+            число потоков для параллельного расчета, по умолчанию - по числу этапов
+        """
+        self._dctStages = {}
+        self.cache = cache if cache is not None else StageCache()
+        self.max_workers = max_workers
+        self.last_run = {}
+        for s in stages or []:
+            self.add(s)
+
+    def add(self, stage:Stage):
+        """добавляет этап в конвейер, возвращает сам конвейер"""
+        assert isinstance(stage, Stage), 'wrong type for param stage'
+        if stage.name in self._dctStages:
+            raise KeyError('этап {} уже есть в конвейере'.format(stage.name))
+        for code2 in stage.outputs:
+            if code2 in self.producers:
+                raise KeyError('ряд {} уже рассчитывается этапом {}'.format(code2, self.producers[code2]))
+        self._dctStages[stage.name] = stage
+        return self
+
+    @property
+    def stages(self)->list:
+        return list(self._dctStages.values())
+
+    @property
+    def producers(self)->dict:
+        return {code2: s.name for s in self._dctStages.values() for code2 in s.outputs}
+
+    @property
+    def dependencies(self)->dict:
+        _prod = self.producers
+        return {s.name: {_prod[c] for c in s.inputs if c in _prod and _prod[c] != s.name}
+                for s in self._dctStages.values()}
+
+    def order(self)->list:
+        """имена этапов в порядке расчета (топологическая сортировка), при цикле - ValueError"""
+        _deps = {k: set(v) for k, v in self.dependencies.items()}
+        lstOrder = []
+        while _deps:
+            ready = [k for k, v in _deps.items() if not v]
+            if not ready:
+                raise ValueError('циклическая зависимость этапов: {}'.format(sorted(_deps)))
+            for k in ready:
+                del _deps[k]
+            for v in _deps.values():
+                v.difference_update(ready)
+            lstOrder.extend(ready)
+        return lstOrder
+
+    def downstream(self, codes)->list:
+        """имена этапов, которые нужно пересчитать при изменении рядов codes, в порядке расчета"""
+        codes = {codes, } if type(codes) == str else set(codes)
+        _deps = self.dependencies
+        lstRes = []
+        for name in self.order():
+            s = self._dctStages[name]
+            if codes.intersection(s.inputs) or _deps[name].intersection(lstRes):
+                lstRes.append(name)
+        return lstRes
+
+    def _check_inputs(self, pdf:pd.DataFrame):
+        # ряд, который этап и читает, и рассчитывает (факт + прогноз, например CPR), должен быть во входном фрейме
+        _prod = self.producers
+        missed = {c for s in self._dctStages.values() for c in s.inputs
+                  if _prod.get(c, s.name) == s.name and c not in pdf.columns}
+        if missed:
+            raise KeyError('во входном фрейме нет рядов: {}'.format(sorted(missed)))
+
+    def _run_stage(self, stage:Stage, pdf:pd.DataFrame):
+        if not stage.memoize:
+            return stage(pdf), 'uncached'
+        key = stage.key(pdf)
+        res = self.cache.get(key)
+        if res is not None:
+            return res, 'cached'
+        res = stage(pdf)
+        self.cache.put(key, res)
+        return res, 'computed'
+
+    @staticmethod
+    def _merge(pdf:pd.DataFrame, res:pd.DataFrame)->pd.DataFrame:
+        """заменяет в рабочем фрейме выходные ряды этапа, расширяя индекс при необходимости (прогнозные годы)"""
+        idx = pdf.index.union(res.index)
+        pdf = pdf.reindex(idx)
+        for c in res.columns:
+            pdf[c] = res[c].reindex(idx)
+        return pdf
+
+    def run(self, pdf:pd.DataFrame)->pd.DataFrame:
+        """рассчитывает все этапы конвейера
+
+        Этапы, все зависимости которых рассчитаны, запускаются параллельно. Каждый этап получает рабочий фрейм
+        с результатами этапов, от которых он зависит. Если результат этапа с тем же ключом уже есть в хранилище,
+        этап не пересчитывается.
+
+        :param pdf: pandas DataFrame
+            исходный рабочий фрейм (индекс - год точки, колонки - коды рядов)
+        :return: pandas DataFrame
+            рабочий фрейм, дополненный выходными рядами всех этапов
+        """
+        self._check_inputs(pdf)
+        _deps = {k: set(v) for k, v in self.dependencies.items()}
+        self.order()  # проверка на циклы до запуска расчета
+
+        _pdf = pdf.copy()
+        self.last_run = {}
+        workers = self.max_workers or max(len(_deps), 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            running = {}
+            while _deps or running:
+                for name in [k for k, v in _deps.items() if not v]:
+                    del _deps[name]
+                    running[executor.submit(self._run_stage, self._dctStages[name], _pdf)] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    name = running.pop(fut)
+                    res, self.last_run[name] = fut.result()
+                    _pdf = Pipeline._merge(_pdf, res)
+                    for v in _deps.values():
+                        v.discard(name)
+
+        # порядок колонок не должен зависеть от того, какой этап закончился раньше
+        lstOut = [c for name in self.order() for c in self._dctStages[name].outputs if c not in pdf.columns]
+        return _pdf[pdf.columns.tolist() + lstOut]
+
+    def __str__(self)->str:
+        return '\n'.join(str(self._dctStages[name]) for name in self.order())
+
+
+def bankruptcy_year_series(result:pd.DataFrame, noza:pd.DataFrame)->pd.DataFrame:
+    """годовые ряды модели банкротств застройщиков: жилая площадь проектов по году ввода - всего и у банкротов
+
+    :param result: pandas DataFrame
+        фрейм с мультииндексом (inn, year) и полем result - флаг банкротства компании в году (model_result в bankrupt_prob)
+    :param noza: pandas DataFrame
+        проекты застройщиков с мультииндексом (inn, year), где year - год ввода, и полем sq_living (pdf_noza в bankrupt_prob)
+    :return: pandas DataFrame
+        индекс - год, поля sq_living (площадь всех проектов) и sq_living_bnkrpt (площадь проектов застройщиков-банкротов)
+    """
+    r = result[['result']].merge(noza[['sq_living']], left_index=True, right_index=True, how='left').dropna(how='any')
+    years = r.index.get_level_values(1)
+    return pd.DataFrame({'sq_living': r['sq_living'].groupby(years).sum(),
+                         'sq_living_bnkrpt': r['sq_living'].where(r['result'] == 1, 0.).groupby(years).sum()}).rename_axis('year')
+
+
+def bankruptcy_share(pdf:pd.DataFrame)->pd.DataFrame:
+    """этап модели банкротств застройщиков: доля площади проектов застройщиков-банкротов в площади проектов года ввода
+
+    Результат - ряд bnkrpt_s (доля новостроек, недостроенных вследствие банкротства застройщиков), который
+    Housing_construction.ipynb сейчас задает вручную."""
+    return pd.DataFrame({'bnkrpt_s': pdf['sq_living_bnkrpt'] / pdf['sq_living']})
+
+
+# ряды модели выбытия жилья - площадь домов групп условий (cond1 - cond10 в Vibitija_main-final.ipynb) по году постройки
+_lstDispsCodes = ['disps_area_{}'.format(i) for i in range(1, 11)]
+
+
+def disps_houses_year_series(houses:pd.DataFrame, conditions:pd.DataFrame, sq_total:float)->pd.DataFrame:
+    """годовые ряды модели выбытия жилья: жилая площадь домов каждой группы условий по году постройки
+
+    Площадь группы приводится к площади жилого фонда так же, как в Vibitija_main-final.ipynb: делится на площадь домов,
+    у которых заполнены поля условия группы, и умножается на sq_total.
+
+    :param houses: pandas DataFrame
+        таблица домов (wdf): built_year, area_residential, floor_count_max и поля условий (house_type, wall_material, ...)
+    :param conditions: pandas DataFrame
+        таблица условий (Cond_df после переименования колонок): share, age, floor_0, floor_1 и поля условий
+    :param sq_total: float
+        площадь жилого фонда, млн м2 (HouseSqTot)
+    :return: pandas DataFrame
+        индекс - год постройки, поля disps_area_1 ... disps_area_N - площадь групп условий в порядке строк conditions, млн м2
+    """
+    assert len(conditions) <= len(_lstDispsCodes), 'too many rows in param conditions'
+    dct = {}
+    for code2, (_, row) in zip(_lstDispsCodes, conditions.iterrows()):
+        body = {k: v for k, v in row.items() if pd.notna(v) and k not in ('age', 'share', 'floor_0', 'floor_1')}
+        mask = pd.Series(True, index=houses.index)
+        for k, v in body.items():
+            mask &= houses[k] == v
+        lstKeys = list(body)
+        if pd.notna(row.get('floor_0')):
+            mask &= houses['floor_count_max'].between(row['floor_0'], row['floor_1'])
+            lstKeys.append('floor_count_max')
+        known = houses.dropna(subset=lstKeys)['area_residential'].sum()
+        area = houses.loc[mask, 'area_residential'].groupby(houses.loc[mask, 'built_year']).sum()
+        dct[code2] = area * sq_total / known
+    return pd.DataFrame(dct).sort_index().rename_axis('year')
+
+
+def disps_houses(pdf:pd.DataFrame, conditions:pd.DataFrame, years=range(2015, 2036))->pd.DataFrame:
+    """этап модели выбытия жилья: выбытие жилой площади МКД по годам, млн м2 (строка Total таблицы disps_result)
+
+    Дом выбывает, когда его возраст достигает возраста своей группы условий: выбытие года равно сумме по группам
+    долей учитываемого фонда (share), умноженных на площадь домов группы, построенных не позднее (год - age).
+    Группа без возраста (аварийные дома) учитывается целиком.
+
+    :param pdf: pandas DataFrame
+        ряды disps_area_* (см. disps_houses_year_series), индекс - год постройки
+    :param conditions: pandas DataFrame
+        таблица условий, используются поля age и share
+    :param years: iterable
+        годы расчета выбытий
+    """
+    years = np.asarray(years)
+    res = np.zeros(len(years))
+    for code2, (age, share) in zip(_lstDispsCodes, conditions[['age', 'share']].itertuples(index=False)):
+        area = pdf[code2].fillna(0.)
+        share = 1. if pd.isna(share) else share
+        if pd.isna(age):
+            res += share * area.sum()
+        else:
+            res += share * area.cumsum().reindex(years - int(age), method='ffill').fillna(0.).to_numpy()
+    return pd.DataFrame({'disps_houses_x': res}, index=pd.Index(years, name=pdf.index.name))
+
+
+# объявления входных и выходных рядов (коды code2) моделей комплекса.
+# Входы - списки рядов, которые модели запрашивают из year, exog_year, exog_param и svod (lstYearCodes, lstSvod, lstFields
+# в страницах Юпитер), выходы - ряды, которые модели рассчитывают и которые читают другие модели.
+# Ряд может быть и входом, и выходом одной модели: фактические значения продлеваются прогнозом.
+# CPR прогнозируют и спрос на ипотеку, и досрочное погашение. Владелец ряда - спрос на ипотеку: досрочное погашение
+# читает его прогноз loan_rate, поэтому рассчитывается после него (иначе граф зависимостей замкнется в цикл);
+# собственный прогноз досрочного погашения - ряд CPR_repay.
+# Банкротства застройщиков и выбытие жилья считаются по таблицам компаний и домов, этапы работают с их годовыми
+# рядами (см. bankruptcy_year_series, disps_houses_year_series) и имеют функции расчета в этом модуле (func).
+dctModelStages = {
+    'demand_mortgage': {
+        'inputs': ['ZPN_I', 'ZPR_I', 'Unmpl_s', 'Inc_x', 'MEPop', 'DispPop', 'GDP_x', 'CPIAv', 'KeyRate',
+                   'HHAv', 'Pop_x', 'p_MortgLifeAv_x', 'p_ProbDef', 'ConstrPriceIZD_x', 'p_superrich',
+                   'loans_and_ref_vol_MKD_vtor', 'ipot_debt', 'ipot_debt_prava', 'loans_and_ref_vol_MKD',
+                   'sdelkiddy_ipot_x', 'sdelkikp_ipot_x', 'portf_rate', 'portf_term',
+                   'loans_vol_MKD_perv', 'refinance_vol', 'ICB', 'loan_rate', 'outstanding_debt_s',
+                   'loan_vol_av', 'UZUipot_x', 'ZhilFondunits', 'ZhilFondIZDunits', 'CPR', 'Activ_x',
+                   'excess_of_flat_cost', 's_ipot_inIZDVvody', 's_ipot_inFPVvody',
+                   'price1mddy_alt_x', 'price1mall_alt_x', 'price1mall_x', 'ZhilFond', 'ZhilFondIZD', 'VvodyMKDunits',
+                   'AvSqIZD', 'VvodyIZD', 'AddIZD_x', 'AvSqVv', 'AvSqDdy', 'AvSqVtor'],
+        'outputs': ['sdelkiddy_ipot_x', 'sdelkikp_ipot_x', 'squareddy_ipot_x', 'squarekp_ipot_x', 'loan_rate', 'CPR'],
+    },
+    'prices_cost': {
+        'inputs': ['Invest_Iq', 'Retail_Iq', 'ZPR_I', 'CPIAv', 'squarekp_ipot_x', 'price1mall_alt_x', 'price1mvtor_alt_x',
+                   'squarekp_ss_x', 'squareddy_x', 'ProjectsPrivate_x', 'price1mperv_alt_x', 'seb1m_x',
+                   'p_LabProdOnCost', 'p_GovPolOnCost', 'price1mddy_alt_x'],
+        'outputs': ['_m1_price_limit'],
+    },
+    'balance_zapusk': {
+        'inputs': ['squareddy_x', 'squareddy_ipot_x', 'squareddy_ss_x',
+                   'ProjectsPrivate_x', 'BldProcMKD', 'VvodyMKD_private'],
+        'outputs': ['sold_stock_in', 'unsold_stock_in', 'sold_stock', 'unsold_stock', 'sold_stock_out', 'unsold_stock_out'],
+    },
+    'demand_om': {
+        'inputs': ['squareddy_ss_x', 'CPIAv', 'Pop_x', 'HHAv', 'Unmpl_s', 'DispInc_rI', 'Inc_x', 'p_ProbDef',
+                   'UZUss_x', 'MEPop', 'DispPop', 'LivMin', 'p_superrich', 'sdelkiddy_ss_x', 'sdelkikp_ss_x',
+                   'squarekp_ss_x', 'DispInc_I', 'oldpravaddy_x', 'longarenda', 'izavarijnogo',
+                   'kapremont', 'partinZSK', 'Badzhilfond_x', 'sdelkikp_x',
+                   'price1mddy_alt_x', 'price1mall_alt_x', 'AvSqDdy', 'AvSqVtor', 'VvodyIZDunits', 'VvodyMKD',
+                   'VvodyMKD_inst', 'VvodyMKD_gov', 'VvodyIZD', 'VvodyMKDunits', 'sdelkiddy_x'],
+        'outputs': ['squareddy_ss_x', 'squarekp_ss_x', 'sdelkiddy_ss_x', 'sdelkikp_ss_x',
+                    'oldsdelkiddy_x', 'sdelki_other', 'socnaim'],
+    },
+    'repayment': {
+        'inputs': ['CPIAv', 'LevelRate', 'loan_rate', 'p_MortgLifeAv_x', 'loans_and_ref_vol_MKD', 'CPR'],
+        'outputs': ['CPR_repay'],
+    },
+    'bankruptcy': {
+        'inputs': ['sq_living', 'sq_living_bnkrpt'],
+        'outputs': ['bnkrpt_s'],
+        'func': bankruptcy_share,
+    },
+    'disps_houses': {
+        'inputs': _lstDispsCodes,
+        'outputs': ['disps_houses_x'],
+        'func': disps_houses,
+    },
+}
+
+
+def model_stage(name:str, func=None, params:dict=None)->Stage:
+    """этап для модели комплекса с входами и выходами из dctModelStages
+
+    Для банкротств застройщиков и выбытия жилья функция расчета берется из объявления:
+        pl.add(model_stage('disps_houses', params={'conditions': Cond_df}))
+    Для остальных моделей функция расчета передается из страницы Юпитер и должна получать все данные через pdf и params,
+    например:
+        pl.add(model_stage('repayment', calc_repayment, params={'iLastFactYear': iLastFactYear}))
+    Если функция читает атрибуты классов модели (repay_e.pdfWork, prices_cost.cElastiCo), этап не запоминается (см. Stage).
+    """
+    if name not in dctModelStages:
+        raise KeyError('модель {} не объявлена в dctModelStages'.format(name))
+    dct = dctModelStages[name]
+    func = dct.get('func') if func is None else func
+    if func is None:
+        raise ValueError('для модели {} нужно передать функцию расчета func'.format(name))
+    return Stage(name, func, dct['inputs'], dct['outputs'], params=params)
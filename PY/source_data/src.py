@@ -9,18 +9,22 @@
  например, из памяти или сsv-файлов)
  :abcDataSource - абстрактный класс, общий предок для классов загрузки данных. Основная функция, реализуемая в потомках: - маке_frame,
  формирует и возвращает фрейм данных в форматах Питон-моделей
+ :DBBackends - перечисление для выбора способа подключения к sqlite3 (SQLAlchemy или стандартный модуль sqlite3)
+ :sqlite_connection, clear_connections - кеш подключений sqlite3 на чтение (для DBBackends.SQLITE3)
  :db_source - класс для чтения данных из файлов sqlite3, основного источника данных для Питон-моделей
  :excel_source - класс  для чтения данных из файлов MS Excel
 
 """
 
 import pandas as pd
-from sqlalchemy import create_engine, MetaData
 
 from abc import ABC, abstractmethod
 from enum import Enum
-from os import path
+from os import path, getpid, stat
+from urllib.request import pathname2url
 import re
+import sqlite3
+import threading
 
 class RowTypes(Enum):
     """Перечисление задает константы-флаги для удобства установки или определения типа загруженных рядов"""
@@ -43,6 +47,50 @@ class SourceTypes(Enum):
     SQLITE = 0
     EXCEL = 1
 
+class DBBackends(Enum):
+    """Перечисление задает способ подключения db_source к файлам sqlite3
+
+    SQLALCHEMY - подключение через движок SQLAlchemy (импортируется только при выборе этого способа)
+    SQLITE3 - подключение стандартным модулем sqlite3 только на чтение, с кешем подключений на процесс.
+    Не требует импорта SQLAlchemy и отражения схемы бд, быстрее для коротко живущих процессов и ядер Юпитер
+    """
+
+    SQLALCHEMY = 0
+    SQLITE3 = 1
+
+# кеш подключений sqlite3 на чтение: ключ - (pid процесса, абсолютный путь к файлу бд),
+# значение - (inode, время изменения файла, подключение).
+# pid в ключе нужен, чтобы процессы-потомки (fork) не использовали подключения родителя,
+# inode и время изменения - чтобы после перезаписи файла (svod.sqlite3 перезаписывается моделями) не читать старые данные.
+# Подключения общие для потоков (check_same_thread=False, этапы конвейера pipeline.Pipeline читают бд параллельно),
+# изменения кеша выполняются под блокировкой
+_dctConnections = {}
+_lockConnections = threading.Lock()
+
+def sqlite_connection(strPath:str)->sqlite3.Connection:
+    """возвращает подключение только на чтение к файлу sqlite3, одно на процесс для каждого файла
+
+    Если файл был заменен или изменен после открытия подключения, открывается новое подключение.
+    Старое подключение не закрывается: его еще могут использовать курсоры других потоков, оно закроется,
+    когда на него не останется ссылок"""
+    strAbsPath = path.abspath(strPath)
+    key = (getpid(), strAbsPath)
+    st = stat(strAbsPath)
+    stamp = (st.st_ino, st.st_mtime_ns)
+    with _lockConnections:
+        cached = _dctConnections.get(key)
+        if cached is not None and cached[:2] == stamp:
+            return cached[2]
+        con = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(strAbsPath)), uri=True, check_same_thread=False)
+        _dctConnections[key] = stamp + (con, )
+        return con
+
+def clear_connections():
+    """закрывает и удаляет из кеша все подключения sqlite3 текущего процесса"""
+    with _lockConnections:
+        for key in [k for k in _dctConnections if k[0] == getpid()]:
+            _dctConnections.pop(key)[2].close()
+
 class abcDataSource(ABC):
     """класс-предок для классов источников данных разных форматов
 
@@ -200,8 +248,11 @@ class db_source(abcDataSource):
         список полей таблицы значений в бд (используется для проверки формата), статический
     _lstHeaderTableColumns : list
         список полей таблицы описания радов в бд (используется для проверки формата), статический
-    sql_engine : sqlalchemy engine
-        одключение к базе даных
+    _backend : DBBackends
+        способ подключения к базе данных
+    _sql_engine : sqlalchemy engine
+        подключение к базе даных для DBBackends.SQLALCHEMY (для DBBackends.SQLITE3 - None,
+        подключение берется из кеша при каждом запросе, см. _con и sqlite_connection)
     _whereCond : str
         строка с условием WHERE SQL запроса
 
@@ -225,7 +276,7 @@ from {data_table} join {headers_table} on {data_table}.code = {headers_table}.co
     _lstDataTableColumns=['code', 'date', 'value']
     _lstHeaderTableColumns = ['code', 'mgroup_id', 'name', 'unit', 'code2', 'source', 'params']
 
-    def __init__(self, strPath:str, row_type:RowTypes, lstFields:list):
+    def __init__(self, strPath:str, row_type:RowTypes, lstFields:list, backend:DBBackends=DBBackends.SQLALCHEMY):
         """
 
         :param strPath: str
@@ -234,15 +285,23 @@ from {data_table} join {headers_table} on {data_table}.code = {headers_table}.co
             тип ряда данных - фактический, экзогенный или модельный
         :param lstFields: list
             список кодов (поле code2 таблицы headers бд) для выборки. Может быть строкой - выборка одного ряда
+        :param backend: DBBackends
+            способ подключения к бд - SQLAlchemy или стандартный модуль sqlite3
         """
         assert isinstance(row_type, RowTypes), 'wrong type for param row_type'
         assert type(lstFields) in (str, list, type), 'wrong type for params lstFileds - must be code2 for sqlite'
+        assert isinstance(backend, DBBackends), 'wrong type for param backend'
         assert path.isfile(strPath), 'file {} not found'.format(strPath)
 
         self.name = 'AIGK sqlite-data source class'
         self._row_type=row_type
         self._srcSourcePath=strPath
-        self._sql_engine=create_engine('sqlite+pysqlite:///{}'.format(self.source_path))
+        self._backend=backend
+        if backend==DBBackends.SQLITE3:
+            self._sql_engine=None
+        else:
+            from sqlalchemy import create_engine
+            self._sql_engine=create_engine('sqlite+pysqlite:///{}'.format(self.source_path))
         self._lstFields=lstFields
         self._source_type = SourceTypes.SQLITE
         self._prepare = None
@@ -256,6 +315,11 @@ from {data_table} join {headers_table} on {data_table}.code = {headers_table}.co
         """проверка структуры файла бд по наличию таблиц и полей в таблицах"""
 
         # на самом деле проверка не очень нужна - при неправильной структуре будет ошибка
+        if self._backend==DBBackends.SQLITE3:
+            return (self._pragma_columns(db_source._strDataTable) == set(db_source._lstDataTableColumns) and
+                    self._pragma_columns(db_source._strHearedsTable) == set(db_source._lstHeaderTableColumns))
+
+        from sqlalchemy import MetaData
         MD=MetaData()
         MD.reflect(bind=self._sql_engine)
         try:
@@ -265,6 +329,19 @@ from {data_table} join {headers_table} on {data_table}.code = {headers_table}.co
         except KeyError:
             return False
 
+    def _con(self):
+        """подключение для запросов: движок SQLAlchemy или подключение sqlite3 из кеша (актуальное для текущего файла)"""
+        if self._backend==DBBackends.SQLITE3:
+            return sqlite_connection(self.source_path)
+        return self._sql_engine
+
+    def _pragma_columns(self, strTable:str)->set:
+        """множество полей таблицы по PRAGMA table_info, для отсутствующей таблицы - пустое множество"""
+        return {r[1] for r in self._con().execute('PRAGMA table_info("{}")'.format(strTable))}
+
+    @property
+    def backend(self)->DBBackends:
+        return self._backend
 
     @property
     def table(self):
@@ -277,14 +354,14 @@ from {data_table} join {headers_table} on {data_table}.code = {headers_table}.co
     def dataset_pass(self):
         """возвращает фрейм с заголовками выбранных рядов - описания рядов"""
         return pd.read_sql(db_source.strQueryPass.format(headers_table=db_source._strHearedsTable,
-                                                         where_condition=self._whereCond),  con=self._sql_engine).set_index('code2')
+                                                         where_condition=self._whereCond),  con=self._con()).set_index('code2')
 
     def make_frame(self):
         """возвращает фрейм подготовленный данных
 
         Разворачивает данные в широкую форму, ставит индексом даты (год точки),
         последовательно применяет функции из списка prepare к заданным полям"""
-        self._pdf = pd.read_sql(self.table, con=self._sql_engine).set_index(['date', 'code2']).unstack().reset_index().set_index('date')
+        self._pdf = pd.read_sql(self.table, con=self._con()).set_index(['date', 'code2']).unstack().reset_index().set_index('date')
         self._pdf.columns=[c[1] for c in self._pdf.columns]
         if self._prepare:
             for i in self._prepare:
@@ -1,6 +1,18 @@
 import unittest
-from source_data.src import db_source, excel_source, RowTypes, SourceTypes
-from os import path
+from source_data.src import db_source, excel_source, RowTypes, SourceTypes, DBBackends, clear_connections, \
+    sqlite_connection
+from source_data.fixtures import make_db
+from source_data.pipeline import Stage, StageCache, Pipeline, dctModelStages, model_stage, \
+    bankruptcy_year_series, disps_houses_year_series
+from source_data.panel import Panel, expand_from
+from source_data.backtest import Equation, rolling_ols, backtest
+from os import path, remove, stat, utime
+import numpy as np
+import pandas as pd
+import sqlite3
+import subprocess
+import sys
+import tempfile
 
 class UT_sourcedata(unittest.TestCase):
     _strDBPath = path.join('/home', 'egor', 'git', 'jupyter', 'AIGK', 'DB')
@@ -42,5 +54,390 @@ class UT_sourcedata(unittest.TestCase):
     #     print(x1.check())
 
 
+class UT_sqlite_backend(unittest.TestCase):
+    lstReadFields = ['row_1', 'row_2', 'not_in_sheet']
+    lstCodes = ['row_{}'.format(i) for i in range(5)]
+
+    @classmethod
+    def setUpClass(cls):
+        cls._tmp = tempfile.TemporaryDirectory()
+        cls.strSQLitePath = path.join(cls._tmp.name, 'year.sqlite3')
+        make_db(cls.strSQLitePath, cls.lstCodes)
+
+    @classmethod
+    def tearDownClass(cls):
+        clear_connections()
+        cls._tmp.cleanup()
+
+    def test_same_frame(self):
+        x1 = db_source(self.strSQLitePath, RowTypes.FACT, self.lstReadFields, backend=DBBackends.SQLALCHEMY)
+        x2 = db_source(self.strSQLitePath, RowTypes.FACT, self.lstReadFields, backend=DBBackends.SQLITE3)
+        pd.testing.assert_frame_equal(x1.make_frame(), x2.make_frame())
+        pd.testing.assert_frame_equal(x1.dataset_pass, x2.dataset_pass)
+        self.assertEqual(x2.fields_not_in_source, ['not_in_sheet'])
+
+    def test_check(self):
+        x1 = db_source(self.strSQLitePath, RowTypes.FACT, self.lstReadFields, backend=DBBackends.SQLITE3)
+        self.assertTrue(x1.check())
+        x1._con().execute('select 1')
+        with self.assertRaises(sqlite3.OperationalError):
+            x1._con().execute('create table t (a integer)')
+
+    def test_connection_cache(self):
+        x1 = db_source(self.strSQLitePath, RowTypes.FACT, 'row_1', backend=DBBackends.SQLITE3)
+        x2 = db_source(self.strSQLitePath, RowTypes.EXOG_R, 'row_2', backend=DBBackends.SQLITE3)
+        self.assertIs(x1._con(), x2._con())
+        con = x1._con()
+        clear_connections()
+        self.assertIsNot(x1._con(), con)
+
+    def test_rewritten_file(self):
+        strPath = path.join(self._tmp.name, 'svod.sqlite3')
+        make_db(strPath, self.lstCodes)
+        x1 = db_source(strPath, RowTypes.MODEL, ['row_1', 'row_7'], backend=DBBackends.SQLITE3)
+        x1.make_frame()
+        self.assertEqual(x1.fields_not_in_source, ['row_7'])
+
+        # модель удаляет и заново записывает файл - должны читаться новые данные
+        remove(strPath)
+        make_db(strPath, self.lstCodes + ['row_7'])
+        x1.make_frame()
+        self.assertEqual(x1.fields_not_in_source, [])
+
+    def test_swap_keeps_open_cursor(self):
+        # файл изменен, пока другой поток читает через общее подключение: курсор должен дочитать данные
+        strPath = path.join(self._tmp.name, 'exog_year.sqlite3')
+        make_db(strPath, self.lstCodes)
+        con = sqlite_connection(strPath)
+        cur = con.execute('select value from datas')
+        cur.fetchmany(10)
+        st = stat(strPath)
+        utime(strPath, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        self.assertIsNot(sqlite_connection(strPath), con)
+        self.assertEqual(len(cur.fetchmany(10)), 10)
+        self.assertEqual(len(cur.fetchall()), len(self.lstCodes) * 30 - 20)
+
+    def test_lazy_import(self):
+        strCode = 'import sys, source_data.src; print("sqlalchemy" in sys.modules)'
+        res = subprocess.run([sys.executable, '-c', strCode], capture_output=True, text=True,
+                             cwd=path.dirname(path.dirname(path.abspath(__file__))))
+        self.assertEqual(res.stdout.strip(), 'False')
+
+
+class UT_pipeline(unittest.TestCase):
+    pdfSrc = pd.DataFrame({'CPIAv': [1.0, 2.0, 3.0], 'LevelRate': [5.0, 6.0, 7.0]}, index=[2017, 2018, 2019])
+
+    @staticmethod
+    def _make_pipeline():
+        # счетчик вызовов в замыкании или глобальной переменной изменил бы ключ этапа,
+        # поэтому пересчет проверяется по last_run
+        def _price(pdf, k=1):
+            return pd.DataFrame({'price1mddy_alt_x': pdf['CPIAv'] * k})
+
+        def _rate(pdf):
+            return pd.DataFrame({'loan_rate': pdf['LevelRate'] + 1})
+
+        def _demand(pdf):
+            return pd.DataFrame({'sdelkiddy_x': pdf['price1mddy_alt_x'] / pdf['loan_rate']})
+
+        return Pipeline([Stage('demand', _demand, ['price1mddy_alt_x', 'loan_rate'], 'sdelkiddy_x'),
+                         Stage('prices', _price, 'CPIAv', 'price1mddy_alt_x', params={'k': 10}),
+                         Stage('rate', _rate, 'LevelRate', 'loan_rate')])
+
+    def test_order(self):
+        pl = UT_pipeline._make_pipeline()
+        self.assertEqual(pl.order()[-1], 'demand')
+        self.assertEqual(pl.downstream('CPIAv'), ['prices', 'demand'])
+
+    def test_run(self):
+        pl = UT_pipeline._make_pipeline()
+        pdf = pl.run(UT_pipeline.pdfSrc)
+        self.assertAlmostEqual(pdf.loc[2019, 'sdelkiddy_x'], 30 / 8)
+        self.assertEqual(set(pl.last_run.values()), {'computed'})
+
+    def test_memoization(self):
+        pl = UT_pipeline._make_pipeline()
+        pl.run(UT_pipeline.pdfSrc)
+        pl.run(UT_pipeline.pdfSrc)
+        self.assertEqual(set(pl.last_run.values()), {'cached'})
+
+        pdfChanged = UT_pipeline.pdfSrc.copy()
+        pdfChanged.loc[2019, 'LevelRate'] = 9.0
+        pdf = pl.run(pdfChanged)
+        self.assertEqual(pl.last_run, {'prices': 'cached', 'rate': 'computed', 'demand': 'computed'})
+        self.assertAlmostEqual(pdf.loc[2019, 'sdelkiddy_x'], 3.0)
+
+    def test_errors(self):
+        pl = UT_pipeline._make_pipeline()
+        with self.assertRaises(KeyError):
+            pl.add(Stage('prices2', lambda pdf: pdf, 'CPIAv', 'price1mddy_alt_x'))
+        with self.assertRaises(KeyError):
+            pl.run(UT_pipeline.pdfSrc[['CPIAv']])
+        pl.add(Stage('cycle', lambda pdf: pdf, 'sdelkiddy_x', 'CPIAv'))
+        with self.assertRaises(ValueError):
+            pl.order()
+
+    def test_cache_dir(self):
+        with tempfile.TemporaryDirectory() as strDir:
+            pl = UT_pipeline._make_pipeline()
+            pl.cache = StageCache(strDir)
+            pdf = pl.run(UT_pipeline.pdfSrc)
+
+            # новое хранилище в том же каталоге - как после перезапуска ядра Юпитер
+            pl2 = UT_pipeline._make_pipeline()
+            pl2.cache = StageCache(strDir)
+            pd.testing.assert_frame_equal(pl2.run(UT_pipeline.pdfSrc), pdf)
+            self.assertEqual(set(pl2.last_run.values()), {'cached'})
+
+    def test_key_stable_between_processes(self):
+        # функция с comprehension, lambda и множеством-константой: в repr констант - адреса в памяти,
+        # порядок элементов множества зависит от PYTHONHASHSEED
+        strCode = """
+import pandas as pd
+from source_data.pipeline import Stage
+def _calc(pdf, k=1):
+    d = {c: pdf[c] * k for c in pdf.columns if c in {'CPIAv', 'LevelRate', 'loan_rate'}}
+    return pd.DataFrame(d).apply(lambda x: x + 1)
+pdf = pd.DataFrame({'CPIAv': [1.0, 2.0]}, index=[2018, 2019])
+print(Stage('s', _calc, 'CPIAv', 'CPIAv', params={'k': 2, 'lst': {'a', 'b', 'c'}}).key(pdf))
+"""
+        lstKeys = [subprocess.run([sys.executable, '-c', strCode], capture_output=True, text=True, check=True,
+                                  cwd=path.dirname(path.dirname(path.abspath(__file__)))).stdout for _ in range(3)]
+        self.assertEqual(len(set(lstKeys)), 1)
+
+    def test_key_params_and_globals(self):
+        pdf = UT_pipeline.pdfSrc
+        arr = np.zeros(10000)
+        arr2 = arr.copy()
+        arr2[5000] = 1
+        k1 = Stage('s', _stage_with_global, 'CPIAv', 'CPIAv', params={'arr': arr}).key(pdf)
+        k2 = Stage('s', _stage_with_global, 'CPIAv', 'CPIAv', params={'arr': arr2}).key(pdf)
+        self.assertNotEqual(k1, k2)
+
+        global iLastFactYear
+        iLastFactYear = 2020
+        self.assertNotEqual(Stage('s', _stage_with_global, 'CPIAv', 'CPIAv', params={'arr': arr}).key(pdf), k1)
+        iLastFactYear = 2019
+        self.assertEqual(Stage('s', _stage_with_global, 'CPIAv', 'CPIAv', params={'arr': arr}).key(pdf), k1)
+
+    def test_model_stages(self):
+        pl = Pipeline([model_stage(name, None if 'func' in dct else (lambda pdf: pdf))
+                       for name, dct in dctModelStages.items()])
+        self.assertEqual(pl.dependencies['balance_zapusk'], {'demand_om', 'demand_mortgage'})
+        self.assertEqual(pl.dependencies['prices_cost'], {'demand_om', 'demand_mortgage'})
+        self.assertEqual(pl.dependencies['repayment'], {'demand_mortgage'})
+        self.assertEqual(pl.producers['CPR'], 'demand_mortgage')
+        self.assertEqual(pl.downstream('squareddy_ss_x'), ['demand_om', 'prices_cost', 'balance_zapusk'])
+        with self.assertRaises(ValueError):
+            model_stage('repayment')
+
+    def test_class_attrs(self):
+        with self.assertWarns(UserWarning):
+            s = Stage('prices', _stage_with_class, 'CPIAv', 'CPIAv')
+        self.assertEqual(s.class_attrs, ['_prices.cElastiCo'])
+        self.assertFalse(s.memoize)
+        pl = Pipeline([s])
+        pl.run(UT_pipeline.pdfSrc)
+        pl.run(UT_pipeline.pdfSrc)
+        self.assertEqual(pl.last_run, {'prices': 'uncached'})
+        self.assertEqual(len(pl.cache), 0)
+
+        # перечисления - константы, этап запоминается
+        self.assertTrue(Stage('s', lambda pdf: pdf if RowTypes.FACT else None, 'CPIAv', 'CPIAv').memoize)
+
+    def test_bankruptcy_stage(self):
+        idx = pd.MultiIndex.from_tuples([('01', 2020), ('01', 2021), ('02', 2020), ('02', 2021)], names=['inn', 'year'])
+        result = pd.DataFrame({'result': [0, 1, 0, 0]}, index=idx)
+        noza = pd.DataFrame({'sq_living': [10., 30., 20., 50., 60.]},
+                            index=pd.MultiIndex.from_tuples([('01', 2020), ('01', 2021), ('01', 2021), ('02', 2020),
+                                                             ('02', 2021)], names=['inn', 'year']))
+        pdf = Pipeline([model_stage('bankruptcy')]).run(bankruptcy_year_series(result, noza))
+        pd.testing.assert_series_equal(pdf['bnkrpt_s'], pd.Series([0., 50. / 110.], name='bnkrpt_s',
+                                                                  index=pd.Index([2020, 2021], name='year')))
+
+    def test_disps_houses_stage(self):
+        rng = np.random.default_rng(0)
+        iN = 2000
+        houses = pd.DataFrame({'built_year': rng.integers(1850, 2020, iN),
+                               'area_residential': rng.uniform(500, 5000, iN),
+                               'floor_count_max': rng.integers(1, 20, iN).astype(float),
+                               'wall_material': rng.choice(['Панельные', 'Кирпич', 'Деревянные', None], iN),
+                               'is_alarm': rng.choice(['Да', 'Нет'], iN, p=[0.05, 0.95]),
+                               'house_type': 'Многоквартирный дом'})
+        houses.loc[houses.sample(100, random_state=0).index, 'floor_count_max'] = np.nan
+        conditions = pd.DataFrame([{'share': 1, 'age': 50, 'is_alarm': 'Нет', 'wall_material': 'Деревянные',
+                                    'house_type': 'Многоквартирный дом'},
+                                   {'share': 0.7, 'age': 60, 'floor_0': 1, 'floor_1': 5, 'is_alarm': 'Нет',
+                                    'wall_material': 'Панельные', 'house_type': 'Многоквартирный дом'},
+                                   {'is_alarm': 'Да', 'house_type': 'Многоквартирный дом'}])
+
+        # расчет как в Vibitija_main-final.ipynb: для каждого условия и года - отбор домов по всей таблице
+        lstYears = list(range(2015, 2036))
+        expected = np.zeros(len(lstYears))
+        for _, row in conditions.iterrows():
+            body = {k: v for k, v in row.items() if pd.notna(v) and k not in ('age', 'share', 'floor_0', 'floor_1')}
+            mask = np.logical_and.reduce([houses[k] == v for k, v in body.items()])
+            if pd.notna(row['floor_0']):
+                mask &= houses['floor_count_max'].between(row['floor_0'], row['floor_1'])
+                body['floor_count_max'] = None
+            known = houses.dropna(subset=list(body))['area_residential'].sum()
+            share = 1 if pd.isna(row['share']) else row['share']
+            for i, col in enumerate(lstYears):
+                msk = mask & (col - houses['built_year'] >= row['age']) if pd.notna(row['age']) else mask
+                expected[i] += houses[msk]['area_residential'].sum() * 2353. / known * share
+
+        pdfYear = disps_houses_year_series(houses, conditions, 2353.)
+        pdfYear = pdfYear.reindex(columns=dctModelStages['disps_houses']['inputs'])  # групп условий меньше, чем в модели
+        pdf = Pipeline([model_stage('disps_houses', params={'conditions': conditions})]).run(pdfYear)
+        np.testing.assert_allclose(pdf.loc[lstYears, 'disps_houses_x'].to_numpy(), expected, rtol=1e-12)
+
+
+iLastFactYear = 2019
+
+
+def _stage_with_global(pdf, arr=None):
+    return pdf.loc[:iLastFactYear]
+
+
+class _prices:
+    cElastiCo = 0.05
+
+
+def _elasticity():
+    return _prices.cElastiCo
+
+
+def _stage_with_class(pdf):
+    return pdf * (1 + _elasticity())
+
+
+class UT_panel(unittest.TestCase):
+
+    @staticmethod
+    def _make_frame():
+        rng = np.random.default_rng(0)
+        lstIdx = [(inn, y) for inn in ['0107030022', '0225010632', '9909127226', '0104014512']
+                  for y in range(2010, 2010 + int(rng.integers(1, 8)))]
+        pdf = pd.DataFrame({'ROA_par': rng.normal(size=len(lstIdx)), 'LOAN_par': rng.normal(size=len(lstIdx)),
+                            'Y': (rng.random(len(lstIdx)) > 0.7).astype(int)},
+                           index=pd.MultiIndex.from_tuples(lstIdx, names=['inn', 'year']))
+        pdf.iloc[[1, 5], 0] = np.nan
+        return pdf.sample(frac=1, random_state=1)  # Panel упорядочивает строки по годам сам, результат - в исходном порядке
+
+    def test_shift(self):
+        pdf = UT_panel._make_frame()
+        pan = Panel(pdf)
+        for p in (1, 2, -1):
+            pd.testing.assert_frame_equal(pan.shift(pdf, ['ROA_par', 'LOAN_par'], p),
+                                          pdf.sort_index().groupby(level=0)[['ROA_par', 'LOAN_par']].shift(p)
+                                          .reindex(pdf.index))
+
+    def test_rolling(self):
+        pdf = UT_panel._make_frame().sort_index()
+        pan = Panel(pdf)
+        pd.testing.assert_frame_equal(pan.rolling_mean(pdf, 'ROA_par', 3),
+                                      pdf.groupby(level=0)[['ROA_par']].rolling(3).mean().droplevel(0))
+        pd.testing.assert_frame_equal(pan.rolling_sum(pdf, 'LOAN_par', 2, min_periods=1),
+                                      pdf.groupby(level=0)[['LOAN_par']].rolling(2, min_periods=1).sum().droplevel(0))
+
+    def test_rolling_inf_and_large(self):
+        idx = pd.MultiIndex.from_product([['a', 'b', 'c'], range(2010, 2016)], names=['inn', 'year'])
+        pdf = pd.DataFrame({'ROA_par': np.arange(18, dtype=float)}, index=idx)
+        pdf.iloc[2, 0] = np.inf  # например, ROA при нулевых активах
+        rng = np.random.default_rng(0)
+        pdf['LOAN_par'] = rng.normal(1e9, 1e8, 18)
+        pdf.iloc[[3, 10], 1] = [5e15, -3e14]  # выбросы
+
+        pan = Panel(pdf)
+        for w, m in ((3, None), (3, 1)):
+            pdfRef = pdf.groupby(level=0)[['ROA_par', 'LOAN_par']].rolling(w, min_periods=m).mean().droplevel(0)
+            pd.testing.assert_frame_equal(pan.rolling_mean(pdf, ['ROA_par', 'LOAN_par'], w, min_periods=m), pdfRef,
+                                          rtol=1e-12)
+        self.assertFalse(pan.rolling_mean(pdf, 'ROA_par', 3).loc['b'].isna().all().item())
+
+    def test_ffill(self):
+        pdf = UT_panel._make_frame()
+        pd.testing.assert_frame_equal(Panel(pdf).ffill(pdf, 'ROA_par'),
+                                      pdf.sort_index().groupby(level=0)[['ROA_par']].ffill().reindex(pdf.index))
+
+    def test_first_event(self):
+        pdf = UT_panel._make_frame()
+        res = Panel(pdf.index).first_event(pdf, 'Y')
+        pdfY = pdf[pdf['Y'] == 1].reset_index().groupby('inn')['year'].min()
+        pd.testing.assert_series_equal(res, pdfY, check_names=False, check_index_type=False)
+
+        mi = expand_from(res, 2020)
+        self.assertEqual(len(mi), (2020 - res + 1).sum())
+        self.assertEqual(mi[0], (res.index[0], res.iloc[0]))
+
+    def test_cross_section(self):
+        pdf = UT_panel._make_frame()
+        pan = Panel(pdf)
+        for y in pan.years:
+            pd.testing.assert_frame_equal(pan.cross_section(pdf, y), pdf.sort_index().loc[pd.IndexSlice[:, y], :])
+
+        # запись среза по номерам строк года, как в цикле прогноза bankrupt_prob.ipynb
+        pdfCS = pan.cross_section(pdf, pan.years[0])
+        pdf.iloc[pan.year_rows(pan.years[0]), 0] = pdfCS['ROA_par'] + 1
+        self.assertTrue(np.allclose(pan.cross_section(pdf, pan.years[0])['ROA_par'], pdfCS['ROA_par'] + 1,
+                                    equal_nan=True))
+
+    def test_frame_columns(self):
+        # панель хранит только индекс: поля, добавленные во фрейм после ее создания, доступны без перестроения
+        pdf = UT_panel._make_frame()
+        pan = Panel(pdf)
+        pdf['Z_A_par'] = pdf['LOAN_par'] * 2
+        pd.testing.assert_frame_equal(pan.lag(pdf, 'Z_A_par'),
+                                      pan.lag(pdf, 'LOAN_par').rename(columns={'LOAN_par': 'Z_A_par'}) * 2)
+        with self.assertRaises(ValueError):
+            pan.lag(pdf.iloc[1:], 'Z_A_par')
+
+
+class UT_backtest(unittest.TestCase):
+
+    @staticmethod
+    def _make_frame(seed=0):
+        rng = np.random.default_rng(seed)
+        pdf = pd.DataFrame({'unsold_stock': rng.normal(10, 2, 15), 'D14': 0.0}, index=pd.Index(range(2005, 2020), name='date'))
+        pdf.loc[2014, 'D14'] = 1.0
+        pdf['unsold_stock_out'] = 0.4 * pdf['unsold_stock'].shift(1) + 3 * pdf['D14'] + rng.normal(0, 0.1, 15)
+        return pdf
+
+    def test_equation(self):
+        eq = Equation('unsold_stock_out ~ unsold_stock.shift(1) + D14 -1')
+        self.assertEqual(eq.names, ['unsold_stock.shift(1)', 'D14'])
+        self.assertEqual(Equation('CPR ~ _wamvipp + _D1').names, ['Intercept', '_wamvipp', '_D1'])
+        with self.assertRaises(ValueError):
+            Equation('CPR ~ np.log(_wamvipp)')
+
+    def test_rolling_ols(self):
+        pdf = UT_backtest._make_frame()
+        y, X = Equation('unsold_stock_out ~ unsold_stock.shift(1) + D14').design(pdf)
+        for window in (None, 6):
+            beta, nobs = rolling_ols(y[None], X[None], window=window, min_obs=4)
+            for t in range(len(y)):
+                a = 0 if window is None else max(t + 1 - window, 0)
+                msk = ~np.isnan(y[a:t + 1]) & ~np.isnan(X[a:t + 1]).any(axis=1)
+                if msk.sum() < 4:
+                    self.assertTrue(np.isnan(beta[0, t]).all())
+                    continue
+                ref = np.linalg.lstsq(X[a:t + 1][msk], y[a:t + 1][msk], rcond=None)[0]
+                np.testing.assert_allclose(beta[0, t], ref, atol=1e-8)
+                self.assertEqual(nobs[0, t], msk.sum())
+
+    def test_backtest_scenarios(self):
+        dctFrames = {'base': UT_backtest._make_frame(0), 'stress': UT_backtest._make_frame(1)}
+        res = backtest('unsold_stock_out ~ unsold_stock.shift(1) + D14 - 1', dctFrames, window=8)
+        self.assertEqual(res.params.index.get_level_values(0).unique().tolist(), ['base', 'stress'])
+        self.assertAlmostEqual(res.params.loc[('base', 2019), 'unsold_stock.shift(1)'], 0.4, delta=0.05)
+        self.assertEqual(res.rmse.index.tolist(), ['base', 'stress'])
+
+        # ошибка вне выборки - по коэффициентам предыдущего окна
+        pdf = dctFrames['stress']
+        b = res.params.loc[('stress', 2016)]
+        fore = b['unsold_stock.shift(1)'] * pdf.loc[2016, 'unsold_stock'] + b['D14'] * pdf.loc[2017, 'D14']
+        self.assertAlmostEqual(res.errors.loc[('stress', 2017)], pdf.loc[2017, 'unsold_stock_out'] - fore)
+
+
 if __name__ == '__main__':
     unittest.main()